@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import matplotlib.pyplot as plt
 from detection import utils
@@ -6,29 +7,67 @@ import rnn_models
 
 plt.style.use('ggplot')
 
+params = {
+    'epochs': 20,
+    'batch_size': 32,
+    'rnn_hidden_units': 64,
+    'fc_hidden_size': 32,
+    'n_stacks': 2,
+    'dropout_rate': .2,
+    'mixed_precision': True
+}
+
+# stream mini-batches from the chunked HDF5 copy of the dataset instead of loading the arrays
+use_hdf5 = False
+
 #my_path = os.path.abspath(os.path.dirname(__file__))
 #path = os.path.join(my_path, "../../data/all_stations_data.npz")
 path = "D:\\substorm-detection\\data\\all_stations_data_128.npz"
-data = np.load(path)
-X = data['X']
-y = data['y'][:, None]
+path_X = "D:\\substorm-detection\\data\\all_stations_data_128_X.npy"
+path_y = "D:\\substorm-detection\\data\\all_stations_data_128_y.npy"
+path_h5 = "D:\\substorm-detection\\data\\all_stations_data_128.h5"
 train_test_split = .1
 train_val_split = .15
 
-# create train, val and test sets
-train, test = utils.split_data([X, y], train_test_split, random=False, rnn_format=True)
-train, val = utils.split_data(train, train_val_split, random=True, rnn_format=True)
-X_train, y_train = train
-X_val, y_val = val
-X_test, y_test = test
+if use_hdf5:
+    batch_size = params['batch_size']
+    # one time repackaging of the .npz archive into a chunked, shuffled HDF5 file
+    if not os.path.exists(path_h5):
+        data = np.load(path)
+        utils.save_hdf5_dataset(path_h5, data['X'], data['y'], batch_size)
+        del data
+    # contiguous train / val / test ranges, the rows were shuffled when the file was written so these are random
+    # splits. Split points are rounded to whole batches so every step reads one chunk
+    n_examples = utils.HDF5Sequence(path_h5, batch_size).x_shape[0]
+    n_train = int((1 - train_test_split) * n_examples) // batch_size * batch_size
+    n_val = int(train_val_split * n_train) // batch_size * batch_size
+    X_train = utils.HDF5Sequence(path_h5, batch_size, stop=n_train - n_val)
+    X_val = utils.HDF5Sequence(path_h5, batch_size, start=n_train - n_val, stop=n_train)
+    X_test = utils.HDF5Sequence(path_h5, batch_size, start=n_train)
+    y_train = y_val = y_test = None
+else:
+    # one time repackaging of the .npz archive into plain .npy files, np.load can't memory map archive members
+    if not (os.path.exists(path_X) and os.path.exists(path_y)):
+        data = np.load(path)
+        np.save(path_X, data['X'])
+        np.save(path_y, data['y'])
+        del data
+    # memory map the arrays so only the splits that get copied are actually read into memory
+    X = np.load(path_X, mmap_mode='r')
+    # substorm / no substorm, same labels as save_hdf5_dataset writes for the HDF5 path (the dataset script stores
+    # the multiclass labels 0..n_pos_classes)
+    y = (np.load(path_y, mmap_mode='r') > 0).astype(np.int8)[:, None]
 
-X_train, X_val, X_test = utils.rnn_format_x([X_train, X_val, X_test])
-y_train, y_val, y_test = utils.rnn_format_y([y_train, y_val, y_test])
+    # create train, val and test sets
+    train, test = utils.split_data([X, y], train_test_split, random=False)
+    train, val = utils.split_data(train, train_val_split, random=True)
+    X_train, y_train = train
+    X_val, y_val = val
+    X_test, y_test = test
 
-params = {
-    'epochs': 20,
-    'batch_size': 32
-}
+    X_train, X_val, X_test = utils.rnn_format_x([X_train, X_val, X_test])
+    # train_basic_gru has a 2 class output layer
+    y_train, y_val, y_test = utils.rnn_format_y([y_train, y_val, y_test], n_classes=2)
 
 hist, mod = rnn_models.train_basic_gru(X_train, y_train, X_val, y_val, params)
 
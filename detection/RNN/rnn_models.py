@@ -1,5 +1,7 @@
+import os
 import keras
-from keras.layers import GRU, LSTM, SimpleRNN, Input, Dense, concatenate
+import tensorflow as tf
+from keras.layers import GRU, CuDNNGRU, LSTM, SimpleRNN, Input, Dense, SpatialDropout1D, concatenate
 from keras.models import Sequential, Model
 import numpy as np
 from detection import utils
@@ -144,28 +146,82 @@ def stacked_rnn_layer(params, mag_input, sw_input, sw_downsample=2):
     return recurrent_mag, recurrent_sw
 
 
+def gru_layers(units, dropout_rate, use_cudnn, **kwargs):
+    """
+    creates a GRU layer which runs on the cuDNN kernel when use_cudnn is set. CuDNNGRU has no dropout argument so the
+    input dropout is done by a SpatialDropout1D layer in front of it. Like GRU's input dropout it keeps one mask per
+    sequence for every timestep, but it is a single mask shared by all three gates where GRU draws a separate mask per
+    gate, so the two paths regularize similarly, not identically. The plain GRU uses the same gate configuration as
+    cuDNN (sigmoid recurrent activation, reset_after) so weights can be moved between the two.
+    :param units: number of hidden units
+    :param dropout_rate: input dropout rate
+    :param use_cudnn: whether to use CuDNNGRU (GPU only)
+    :param kwargs: passed on to the GRU layer (return_sequences, input_shape, etc.)
+    :return: list of keras layers to add to the model
+    """
+    if not use_cudnn:
+        return [GRU(units, activation='tanh', recurrent_activation='sigmoid', reset_after=True, dropout=dropout_rate,
+                    **kwargs)]
+    dropout_kwargs = {}
+    if 'input_shape' in kwargs:
+        dropout_kwargs['input_shape'] = kwargs.pop('input_shape')
+    return [SpatialDropout1D(dropout_rate, **dropout_kwargs), CuDNNGRU(units, **kwargs)]
+
+
 def train_basic_gru(X_train, y_train, X_val, y_val, params):
     """
-    Trains basic sequential model with stacked GRU layers
+    Trains basic sequential model with stacked GRU layers. X_train and X_val can also be keras Sequences (e.g.
+    utils.HDF5Sequence) which produce the (x, y) batches, in that case y_train and y_val are ignored.
     :param params = {'batch_size',
                     'epochs',
                     'rnn_hidden_units',
                     'fc_hidden_size',
-                    'n_stacks'}
+                    'n_stacks',
+                    'dropout_rate',
+                    'cudnn' (optional, defaults to whether a GPU is available),
+                    'workers' (optional, number of batch loading workers when training from a Sequence),
+                    'use_multiprocessing' (optional, load batches in processes instead of threads, defaults to False on
+                        Windows where the workers are spawned and would re-run the calling script),
+                    'mixed_precision' (optional, train with float16 compute and float32 master weights)}
     :return:
         hist: dict; history of training
         model: keras model object; trained model
     """
+    if 'cudnn' in params:
+        use_cudnn = params['cudnn']
+    else:
+        use_cudnn = tf.test.is_gpu_available(cuda_only=True)
+    if params.get('mixed_precision', False):
+        # the graph rewrite casts the GRU / Dense math to float16 on the GPU, keeps float32 weights and numerically
+        # sensitive ops (softmax, loss) in float32 and adds dynamic loss scaling. It has to be enabled before the
+        # session is created, so the optimizer is set up before the model is built
+        optimizer = keras.optimizers.TFOptimizer(
+            tf.train.experimental.enable_mixed_precision_graph_rewrite(tf.train.AdamOptimizer()))
+    else:
+        optimizer = 'adam'
     model = Sequential()
-    _, n_steps, n_features = np.shape(X_train)
+    from_sequence = isinstance(X_train, keras.utils.Sequence)
+    if from_sequence:
+        _, n_steps, n_features = X_train.input_shape
+    else:
+        _, n_steps, n_features = np.shape(X_train)
     for i in range(params['n_stacks']-1):
-        model.add(GRU(params['rnn_hidden_units'], return_sequences=True, dropout=params['dropout_rate'], input_shape=(n_steps, n_features)))
-    model.add(GRU(params['rnn_hidden_units'], dropout=params['dropout_rate']))
+        for layer in gru_layers(params['rnn_hidden_units'], params['dropout_rate'], use_cudnn, return_sequences=True,
+                                input_shape=(n_steps, n_features)):
+            model.add(layer)
+    for layer in gru_layers(params['rnn_hidden_units'], params['dropout_rate'], use_cudnn):
+        model.add(layer)
     model.add(Dense(params['fc_hidden_size'], activation='relu'))
     model.add(Dense(2, activation='softmax'))
-    model.compile(optimizer='adam', loss='binary_crossentropy',
+    model.compile(optimizer=optimizer, loss='binary_crossentropy',
                   metrics=['accuracy', utils.true_positive, utils.false_positive])
-    hist = model.fit(X_train, y_train, batch_size=params['batch_size'], epochs=params['epochs'],
-                     validation_data=(X_val, y_val))
+    if from_sequence:
+        # batches are read ahead by the workers while the model trains on the current one
+        hist = model.fit_generator(X_train, epochs=params.get('epochs', 20), validation_data=X_val,
+                                   workers=params.get('workers', 4),
+                                   use_multiprocessing=params.get('use_multiprocessing', os.name != 'nt'))
+    else:
+        hist = model.fit(X_train, y_train, batch_size=params.get('batch_size', 32), epochs=params.get('epochs', 20),
+                         validation_data=(X_val, y_val))
 
     return hist, model
@@ -179,18 +179,38 @@ def plot_cam(index):
     plt.pcolormesh(self.cams[index], cmap='coolwarm')
 
 
-def confusion_mtx(y_true, y_pred):
-    y_true = np.ravel(np.array(y_true))
-    y_pred = np.ravel(np.array(y_pred))
-    cm = confusion_matrix(y_true, y_pred, labels=[1, 0])
+def binary_confusion_matrix(y_true, y_pred):
+    """
+    Counts for 0/1 labels, rows are the true label and columns the predicted label. Each (true, pred) pair is packed
+    into a single integer 2 * true + pred so the whole matrix is one bincount.
+    """
+    y_true = np.ravel(y_true)
+    y_pred = np.ravel(y_pred)
+    # check before casting, otherwise e.g. a probability of .7 would silently be counted as 0
+    if not (np.isin(y_true, (0, 1)).all() and np.isin(y_pred, (0, 1)).all()):
+        raise ValueError("binary_confusion_matrix only supports 0/1 labels")
+    y_true = y_true.astype(np.intp)
+    y_pred = y_pred.astype(np.intp)
+    return np.bincount(2 * y_true + y_pred, minlength=4).reshape(2, 2)
+
+
+def confusion_mtx(y_true, y_pred, cm=None):
+    """
+    Row normalized confusion matrix with the positive class first. `cm` can be a precomputed
+    binary_confusion_matrix so the counts don't have to be recomputed.
+    """
+    if cm is None:
+        cm = binary_confusion_matrix(y_true, y_pred)
+    cm = cm[::-1, ::-1]
     cm = cm.astype('float') / cm.sum(axis=1)[:, np.newaxis]
     return cm
 
 
-def plot_confusion_matrix(y_true, y_pred, classes, normalize=False, title=None, cmap=plt.cm.Blues):
+def plot_confusion_matrix(y_true, y_pred, classes, normalize=False, title=None, cmap=plt.cm.Blues, cm=None):
     """
-    This function prints and plots the confusion matrix.
+    This function prints and plots the confusion matrix for binary (0/1) labels.
     Normalization can be applied by setting `normalize=True`.
+    `cm` can be a precomputed binary_confusion_matrix.
     """
     if not title:
         if normalize:
@@ -199,9 +219,8 @@ def plot_confusion_matrix(y_true, y_pred, classes, normalize=False, title=None,
             title = 'Confusion matrix, without normalization'
 
     # Compute confusion matrix
-    cm = confusion_matrix(y_true, y_pred)
-    # Only use the labels that appear in the data
-    classes = classes[unique_labels(y_true, y_pred)]
+    if cm is None:
+        cm = binary_confusion_matrix(y_true, y_pred)
     if normalize:
         cm = cm.astype('float') / cm.sum(axis=1)[:, np.newaxis]
         print("Normalized confusion matrix")
@@ -37,6 +37,7 @@ import keras.backend as K
 import matplotlib.pyplot as plt
 import seaborn as sns
 from skimage import transform
+from numba import njit, prange
 import pandas as pd
 
 from detection.CNN import models
@@ -46,6 +47,46 @@ from detection.analysis import plotting
 sns.set()
 
 
+@njit(parallel=True, fastmath=True)
+def cam_resize(conv_out, weights, out):
+    """
+    Computes class activation maps and linearly upsamples them into `out` in one pass, one example per thread. The
+    sampling grid is the same as scipy.ndimage.zoom(..., order=1): the corners of the input and output are aligned.
+
+    Parameters
+    ----------
+    conv_out: (batch, H, W, channels) output of the last conv layer
+    weights: (channels, ) dense weights for the output class
+    out: (batch, out_H, out_W) array the CAMs are written into
+    """
+    n_batch, n_h, n_w, n_channels = conv_out.shape
+    out_h = out.shape[1]
+    out_w = out.shape[2]
+    scale_h = (n_h - 1) / (out_h - 1) if out_h > 1 else 0.
+    scale_w = (n_w - 1) / (out_w - 1) if out_w > 1 else 0.
+    for b in prange(n_batch):
+        cam = np.empty((n_h, n_w))
+        for i in range(n_h):
+            for j in range(n_w):
+                s = 0.
+                for c in range(n_channels):
+                    s += conv_out[b, i, j, c] * weights[c]
+                cam[i, j] = s
+        for i in range(out_h):
+            y = i * scale_h
+            i0 = min(int(y), n_h - 1)
+            i1 = min(i0 + 1, n_h - 1)
+            fy = y - i0
+            for j in range(out_w):
+                x = j * scale_w
+                j0 = min(int(x), n_w - 1)
+                j1 = min(j0 + 1, n_w - 1)
+                fx = x - j0
+                top = (1 - fx) * cam[i0, j0] + fx * cam[i0, j1]
+                bottom = (1 - fx) * cam[i1, j0] + fx * cam[i1, j1]
+                out[b, i, j] = (1 - fy) * top + fy * bottom
+
+
 class Visualizer:
     
     def __init__(self, data_fn, params, Tp=30, train_model=False, train_val_split=.15,
@@ -64,12 +105,10 @@ class Visualizer:
         self.n_stations = self.mag_data.shape[1]
         self.distance_matrix = utils.distance_matrix(self.station_locations)
 
-        self.mag_cams = self.mag_batch_cam(64, 32)
+        self.mag_cams, self.sw_cams = self.batch_cams(64, 32, 32)
         no_loc_mask = np.any(np.isnan(self.mag_data[:, :, self.mag_input_slice, :2]), axis=-1)
         self.mag_cams[no_loc_mask] = 0
 
-        self.sw_cams = self.sw_batch_cam(64, 32)
-
         y_pred, strength_pred = self.model.predict(self.test_data)
         pred_lab = np.round(y_pred).astype(int)
 
@@ -206,29 +245,28 @@ class Visualizer:
 
         return np.argsort(dists)
 
-    def sw_batch_cam(self, batch_size, sw_channels):
-        dense_weights = self.model.get_layer('time_output').get_weights()[0][:sw_channels, 0]
-        last_conv = K.function(self.model.inputs, [self.model.layers[26].output])
-        cams = np.empty((self.n_examples, self.Tw))
-        for i in range(int(np.ceil(self.n_examples / batch_size))):
-            cbs = min(batch_size, self.n_examples - i * batch_size)
-            x = [self.mag_data[i * batch_size:i * batch_size + cbs, :, self.mag_input_slice, 2:],
-                 self.sw_data[i * batch_size:i * batch_size + cbs, -self.Tw:]]
-            cam = np.sum(last_conv(x)[0] * dense_weights[None, None, :], axis=-1)
-            cams[i * batch_size:i * batch_size + cbs] = transform.resize(cam, (cbs, self.Tw))
-        return cams
-
-    def mag_batch_cam(self, batch_size, mag_channels):
-        dense_weights = self.model.get_layer('time_output').get_weights()[0][-mag_channels:, 0]
-        last_conv = K.function(self.model.inputs, [self.model.layers[-6].output])
-        cams = np.empty((self.n_examples, self.n_stations, self.Tm))
+    def batch_cams(self, batch_size, sw_channels, mag_channels):
+        """
+        Computes the solar wind and magnetometer CAMs together. Both conv outputs are fetched by a single session
+        callable built once up front, so each batch is one forward pass and one call into TF.
+        """
+        dense_weights = self.model.get_layer('time_output').get_weights()[0][:, 0]
+        sw_weights = dense_weights[:sw_channels]
+        mag_weights = dense_weights[-mag_channels:]
+        sess = K.get_session()
+        last_conv = sess.make_callable([self.model.layers[26].output, self.model.layers[-6].output],
+                                       feed_list=self.model.inputs)
+        sw_cams = np.empty((self.n_examples, self.Tw), dtype=np.float32)
+        mag_cams = np.empty((self.n_examples, self.n_stations, self.Tm), dtype=np.float32)
         for i in range(int(np.ceil(self.n_examples / batch_size))):
             cbs = min(batch_size, self.n_examples - i * batch_size)
             x = [self.mag_data[i * batch_size:i * batch_size + cbs, :, self.mag_input_slice, 2:],
                  self.sw_data[i * batch_size:i * batch_size + cbs, -self.Tw:]]
-            cam = np.sum(last_conv(x)[0] * dense_weights[None, None, None, :], axis=-1)
-            cams[i * batch_size:i * batch_size + cbs] = transform.resize(cam, (cbs, self.n_stations, self.Tm))
-        return cams
+            sw_conv, mag_conv = last_conv(*x)
+            # treat the time series as a single row image
+            cam_resize(sw_conv[:, None], sw_weights, sw_cams[i * batch_size:i * batch_size + cbs, None])
+            cam_resize(mag_conv, mag_weights, mag_cams[i * batch_size:i * batch_size + cbs])
+        return mag_cams, sw_cams
 
     def get_substorm_location(self, index):
         mlt_match = np.mod(abs(self.mag_data[index, :, :, 0] - self.ss_locations[index, 0]), 24) == 0
@@ -1,5 +1,5 @@
 import numpy as np
-from detection.utils import confusion_mtx
+from detection.analysis.plotting import confusion_mtx
 from sklearn.linear_model import LogisticRegression
 
 
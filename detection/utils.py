@@ -1,58 +1,102 @@
 import numpy as np
+import tensorflow as tf
+import keras
 import keras.backend as K
-from sklearn.preprocessing import LabelEncoder
-from sklearn.preprocessing import OneHotEncoder
+import h5py
 import math
 import random
 import matplotlib.pyplot as plt
 from pymap3d.vincenty import vdist
 
 
-def split_data(list_of_data, split, random=True, batch_size=None):
+def split_data(list_of_data, split, random=True, batch_size=None, stratify=None, sort_indices=True):
     """this function splits a list of equal length (first dimension) data arrays into two lists. The length of the data
     put into the second list is determined by the 'split' argument. This can be used for slitting [X, y] into
     [X_train, y_train] and [X_val, y_val]
+
+    If 'stratify' is given a label array, the examples of each class are split separately so that both lists keep the
+    class proportions (requires random=True). With random=True the examples are randomly assigned to the lists
+    but, unless 'sort_indices' is False, each list keeps the original ordering so the arrays are gathered in
+    increasing index order (nearly sequential reads) instead of random order.
     """
 
-    split_idx = int((1 - split) * list_of_data[0].shape[0])
+    if stratify is not None and not random:
+        raise ValueError("stratify requires random=True")
 
-    idx = np.arange(list_of_data[0].shape[0])
-    if random:
-        np.random.shuffle(idx)
+    n_samples = list_of_data[0].shape[0]
+    split_idx = int((1 - split) * n_samples)
 
     split_a = []
     split_b = []
 
-    for data in list_of_data:
-        split_a.append(data[idx[:split_idx]])
-        split_b.append(data[idx[split_idx:]])
+    if random:
+        # shuffle a single index vector and reuse it for every array
+        if stratify is None:
+            idx = np.random.permutation(n_samples)
+            idx_a = idx[:split_idx]
+            idx_b = idx[split_idx:]
+        else:
+            labels = np.ravel(stratify)
+            classes, class_sizes = np.unique(labels, return_counts=True)
+            # largest remainder rounding, so the per class sizes of the first list add up to split_idx
+            exact_split = (1 - split) * class_sizes
+            class_split = np.floor(exact_split).astype(int)
+            class_split[np.argsort(class_split - exact_split)[:split_idx - class_split.sum()]] += 1
+            idx_a = []
+            idx_b = []
+            for label, class_split_idx in zip(classes, class_split):
+                idx = np.random.permutation(np.flatnonzero(labels == label))
+                idx_a.append(idx[:class_split_idx])
+                idx_b.append(idx[class_split_idx:])
+            idx_a = np.concatenate(idx_a)
+            idx_b = np.concatenate(idx_b)
+            if not sort_indices:
+                # mix the classes, otherwise they come out grouped
+                idx_a = np.random.permutation(idx_a)
+                idx_b = np.random.permutation(idx_b)
+        if sort_indices:
+            idx_a = np.sort(idx_a)
+            idx_b = np.sort(idx_b)
+        for data in list_of_data:
+            split_a.append(np.take(data, idx_a, axis=0, mode='clip'))
+            split_b.append(np.take(data, idx_b, axis=0, mode='clip'))
+    else:
+        # contiguous slices are views, no copy is made
+        for data in list_of_data:
+            split_a.append(data[:split_idx])
+            split_b.append(data[split_idx:])
 
     if batch_size:
+        remainder_a = split_a[0].shape[0] % batch_size
+        remainder_b = split_b[0].shape[0] % batch_size
         for i in range(len(split_a)):
-            if i == 0:
-                n_samples_a = np.shape(split_a[i])[0]
-                n_samples_b = np.shape(split_b[i])[0]
+            if remainder_a:
+                split_a[i] = split_a[i][:-remainder_a]
+            if remainder_b:
+                split_b[i] = split_b[i][:-remainder_b]
 
-                remainder_a = n_samples_a % batch_size
-                remainder_b = n_samples_b % batch_size
+    return split_a, split_b
 
-            split_a[i] = split_a[i][:-remainder_a]
-            split_b[i] = split_b[i][:-remainder_b]
 
-    return split_a, split_b
+def positive_counts(y_true, y_pred):
+    """
+    single reduction over the batch giving [true positives, positives, predicted positives] for the first output column
+    """
+    y_pos = tf.round(y_true[:, 0])
+    y_pred_pos = tf.round(y_pred[:, 0])
+    return tf.reduce_sum(tf.stack([y_pos * y_pred_pos, y_pos, y_pred_pos], axis=1), axis=0)
 
 
 def true_positive(y_true, y_pred):
-    y_pred_pos = K.round(y_pred[:, 0])
-    y_pos = K.round(y_true[:, 0])
-    return K.sum(y_pos * y_pred_pos) / (K.sum(y_pos) + K.epsilon())
+    counts = positive_counts(y_true, y_pred)
+    return counts[0] / (counts[1] + K.epsilon())
 
 
 def false_positive(y_true, y_pred):
-    y_pred_pos = K.round(y_pred[:, 0])
-    y_pos = K.round(y_true[:, 0])
-    y_neg = 1 - y_pos
-    return K.sum(y_pred_pos * y_neg) / (K.sum(y_neg) + K.epsilon())
+    # false positives = predicted positives - true positives, negatives = batch size - positives
+    counts = positive_counts(y_true, y_pred)
+    n_examples = tf.cast(tf.shape(y_true)[0], counts.dtype)
+    return (counts[2] - counts[0]) / (n_examples - counts[1] + K.epsilon())
 
 
 def distance_matrix(station_locations):
@@ -75,39 +119,106 @@ def rnn_format_x(list_of_x):
     """
     x_rnn = []
     for i in range(len(list_of_x)):
-        a0, a1, a2, a3 = np.shape(list_of_x[i])
-        x_rnn.append(np.reshape(list_of_x[i], (a0, a2, a1*a3)))
+        a0, a1, a2, a3 = list_of_x[i].shape
+        # (examples, stations, time, features) -> (examples, time, stations, features), C-ordered so each
+        # timestep is one contiguous row after the reshape
+        arr = np.ascontiguousarray(np.transpose(list_of_x[i], (0, 2, 1, 3)))
+        x_rnn.append(arr.reshape(a0, a2, a1*a3))
     return x_rnn
 
 
-def rnn_format_y(list_of_y):
+def rnn_format_y(list_of_y, n_classes=None):
     """
     reformats labels into onehot encoding for rnn inputs
-    :param list_of_y: list of label arrays (e.g., y_train, y_val, etc.)
+    :param list_of_y: list of integer label arrays (e.g., y_train, y_val, etc.)
+    :param n_classes: number of onehot columns, should match the model's output layer. Defaults to the largest label
+        over all of the arrays + 1
     :return: y_rnn: list of label arrays in onehot encoding
     """
-    label_encoder = LabelEncoder()
-    onehot_encoder = OneHotEncoder(sparse=False)
+    # labels are integer class indices, onehot is a row lookup into the identity matrix. n_classes is the same for
+    # all of the arrays so every split gets the same encoding
+    if n_classes is None:
+        n_classes = int(max(np.max(y) for y in list_of_y)) + 1
+    onehot = np.eye(n_classes, dtype=np.float32)
     y_rnn = []
     for i in range(len(list_of_y)):
-        integer_encoded = label_encoder.fit_transform(list_of_y[i])
-        integer_encoded = integer_encoded.reshape(len(integer_encoded), 1)
-        y_rnn.append(onehot_encoder.fit_transform(integer_encoded))
+        labels = np.asarray(list_of_y[i]).ravel().astype(np.intp)
+        if labels.size and (labels.min() < 0 or labels.max() >= n_classes):
+            raise ValueError("labels must be in [0, {}), got labels from {} to {}".format(n_classes, labels.min(),
+                                                                                           labels.max()))
+        y_rnn.append(onehot[labels])
     return y_rnn
 
 
+def save_hdf5_dataset(fn, X, y, chunk_size=32):
+    """
+    writes X and y to a chunked HDF5 file for HDF5Sequence. The labels are collapsed to binary (substorm / no substorm,
+    y > 0) to match the RNN models, and the number of classes is stored in the file's 'n_classes' attribute. The
+    datasets are built with all the positive examples of a year before the negative ones, so the rows are shuffled once
+    here, otherwise every contiguous batch would be almost entirely one class. Each chunk holds chunk_size examples,
+    which should match the training batch size.
+    """
+    n_examples = X.shape[0]
+    chunk_size = min(chunk_size, n_examples)
+    order = np.random.permutation(n_examples)
+    y = (np.ravel(y) > 0).astype(np.int8)
+    with h5py.File(fn, 'w') as f:
+        f.attrs['n_classes'] = 2
+        f.create_dataset('y', data=y[order], chunks=(chunk_size,), compression='lzf')
+        X_out = f.create_dataset('X', shape=X.shape, dtype=X.dtype, chunks=(chunk_size,) + X.shape[1:],
+                                 compression='lzf')
+        # one chunk at a time so the shuffled copy of X is never fully in memory
+        for i in range(0, n_examples, chunk_size):
+            X_out[i:i + chunk_size] = X[order[i:i + chunk_size]]
+
+
+class HDF5Sequence(keras.utils.Sequence):
+    """
+    keras Sequence which streams RNN formatted mini-batches out of a chunked HDF5 dataset written by save_hdf5_dataset,
+    so only one batch at a time is held in memory. Each step reads the examples
+    [start + i * batch_size, start + (i + 1) * batch_size), start should be a multiple of the file's chunk size so every
+    step reads exactly one chunk. The rows are shuffled when the file is written, so contiguous ranges are random
+    subsets. n_classes defaults to the file's 'n_classes' attribute. The file is opened on the first read so each
+    worker process gets its own handle.
+    """
+
+    def __init__(self, fn, batch_size, start=0, stop=None, n_classes=None):
+        self.fn = fn
+        self.batch_size = batch_size
+        with h5py.File(fn, 'r') as f:
+            self.x_shape = f['X'].shape
+            self.n_classes = int(f.attrs['n_classes']) if n_classes is None else n_classes
+        self.start = start
+        self.stop = self.x_shape[0] if stop is None else stop
+        self.file = None
+
+    @property
+    def input_shape(self):
+        """shape of the formatted input: (examples, time, stations * features)"""
+        return self.stop - self.start, self.x_shape[2], self.x_shape[1] * self.x_shape[3]
+
+    def __len__(self):
+        return int(np.ceil((self.stop - self.start) / self.batch_size))
+
+    def __getitem__(self, idx):
+        if self.file is None:
+            self.file = h5py.File(self.fn, 'r')
+        batch_start = self.start + idx * self.batch_size
+        batch_stop = min(batch_start + self.batch_size, self.stop)
+        X = rnn_format_x([self.file['X'][batch_start:batch_stop]])[0]
+        # same encoding as rnn_format_y, but with a fixed number of classes so every batch matches
+        y = np.eye(self.n_classes, dtype=np.float32)[self.file['y'][batch_start:batch_stop].astype(np.intp)]
+        return X, y
+
+
 def linear_format_x(list_of_x):
     """
     reformats list of feature arrays for linear classification
     :param list_of_x: list of feature arrays (e.g., X_train, X_val, etc.)
     :return: x_linear: list of feature arrays
     """
-    x_linear = []
-    for i in range(len(list_of_x)):
-        a0, a1, a2 = np.shape(list_of_x[i])
-        x_linear.append(np.reshape(list_of_x[i], (a0, a1 * a2)))
-        #a0, a1, a2, a3 = np.shape(list_of_x[i])
-        #x_linear.append(np.reshape(list_of_x[i], (a0, a1*a2*a3)))
+    # flattens every axis after the first, works for both (N, a1, a2) and (N, a1, a2, a3) arrays
+    x_linear = [np.ascontiguousarray(x).reshape(x.shape[0], -1) for x in list_of_x]
     return x_linear
 
 
@@ -117,9 +228,7 @@ def linear_format_y(list_of_y):
     :param list_of_y: list of feature arrays (e.g., y_train, y_val, etc.)
     :return: x_linear: list of feature arrays
     """
-    y_linear = []
-    for i in range(len(list_of_y)):
-        y_linear.append(np.ravel(list_of_y[i]))
+    y_linear = [np.reshape(y, -1) for y in list_of_y]
     return y_linear
 
 